@@ -5,33 +5,38 @@ import logging
 # Use os.getenv to get environment variables.
 # For local development, you can set these in a .env file and use python-dotenv.
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Max simultaneous connections in the Bot's shared aiohttp session (used by polling and all sends).
+BOT_SESSION_CONNECTION_LIMIT = int(os.getenv("BOT_SESSION_CONNECTION_LIMIT", "100"))
 
 # Default values for Firebase and App ID, useful for local testing
 DEFAULT_APP_ID = 'default-night-mode-bot'
 FIREBASE_CONFIG_PLACEHOLDER = '{}'
 
 # --- Firebase Global Instances (will be set dynamically) ---
-_firestore_db_instance = None
-_app_id_instance = None
+# Stored together so hot paths can fetch both with a single lookup via get_fs().
+_fs = (None, None) # (firestore_db, app_id)
 
 def set_firestore_instance(db_instance, app_id_val):
     """Sets the global Firestore DB instance and app ID."""
-    global _firestore_db_instance, _app_id_instance
-    _firestore_db_instance = db_instance
-    _app_id_instance = app_id_val
-    logging.info(f"Firestore instance and app ID '{app_id_val}' set in config.")
+    global _fs
+    _fs = (db_instance, app_id_val)
+    logging.info("Firestore instance and app ID '%s' set in config.", app_id_val)
+
+def get_fs() -> tuple:
+    """Returns the (Firestore DB instance, app ID) pair without any checks."""
+    return _fs
 
 def get_firestore_db():
     """Returns the global Firestore DB instance."""
-    if _firestore_db_instance is None:
+    if _fs[0] is None:
         logging.warning("Firestore DB instance not yet initialized.")
-    return _firestore_db_instance
+    return _fs[0]
 
 def get_app_id():
     """Returns the global app ID."""
-    if _app_id_instance is None:
+    if _fs[1] is None:
         logging.warning("App ID instance not yet initialized.")
-    return _app_id_instance
+    return _fs[1]
 
 # --- Firestore Collection Paths ---
 # Use format strings for app_id and user_id, which will be filled at runtime.
@@ -1,105 +1,132 @@
-import asyncio
 import logging
-from firebase_admin import firestore
+from typing import Optional
+from google.cloud import firestore
+from google.api_core.exceptions import NotFound
 import config
 
 logger = logging.getLogger(__name__)
 
+def _settings_doc_ref(db, app_id: str, user_id: int):
+    """Returns the reference to a user's night mode settings document."""
+    user_settings_collection_path = config.USERS_COLLECTION.format(app_id=app_id, userId=str(user_id))
+    return db.collection(user_settings_collection_path).document(str(user_id)).collection("settings").document("night_mode")
+
+def _scheduled_media_collection_ref(db, app_id: str, user_id: int):
+    """Returns the reference to a user's scheduled_media subcollection."""
+    user_scheduled_media_collection_path = config.USERS_COLLECTION.format(app_id=app_id, userId=str(user_id))
+    return db.collection(user_scheduled_media_collection_path).document(str(user_id)).collection("scheduled_media")
+
 async def get_user_settings(user_id: int) -> dict:
     """Fetches user settings from Firestore."""
-    db = config.get_firestore_db()
-    app_id = config.get_app_id()
+    db, app_id = config.get_fs()
     if not db:
         logger.error("Firestore DB not available.")
         return {}
-    
-    # Construct the user-specific collection path
-    user_settings_collection_path = config.USERS_COLLECTION.format(app_id=app_id, userId=str(user_id))
-    doc_ref = db.collection(user_settings_collection_path).document(str(user_id)).collection("settings").document("night_mode")
-    
+
+    doc_ref = _settings_doc_ref(db, app_id, user_id)
+
     try:
-        doc = await asyncio.to_thread(doc_ref.get)
+        doc = await doc_ref.get()
         return doc.to_dict() if doc.exists else {}
     except Exception as e:
-        logger.error(f"Error fetching settings for user {user_id}: {e}")
+        logger.error("Error fetching settings for user %s: %s", user_id, e)
         return {}
 
 async def update_user_settings(user_id: int, settings: dict):
-    """Updates user settings in Firestore."""
-    db = config.get_firestore_db()
-    app_id = config.get_app_id()
+    """Updates user settings in Firestore. Values may be firestore.DELETE_FIELD to remove a field."""
+    db, app_id = config.get_fs()
     if not db:
         logger.error("Firestore DB not available. Cannot update settings.")
         return
-    
-    user_settings_collection_path = config.USERS_COLLECTION.format(app_id=app_id, userId=str(user_id))
-    doc_ref = db.collection(user_settings_collection_path).document(str(user_id)).collection("settings").document("night_mode")
-    
+
+    doc_ref = _settings_doc_ref(db, app_id, user_id)
+
     try:
-        await asyncio.to_thread(doc_ref.set, settings, merge=True)
-        logger.info(f"Updated settings for user {user_id}: {settings}")
+        await doc_ref.set(settings, merge=True)
+        logger.info("Updated settings for user %s: %s", user_id, settings)
     except Exception as e:
-        logger.error(f"Error updating settings for user {user_id}: {e}")
+        logger.error("Error updating settings for user %s: %s", user_id, e)
+
+async def clear_settings_fields(user_id: int, fields: list[str]) -> bool:
+    """Removes the given fields from the user's settings document in a single write.
+
+    Uses a merge write rather than update(), so a missing settings document is not an error.
+    """
+    db, app_id = config.get_fs()
+    if not db:
+        logger.error("Firestore DB not available. Cannot clear settings.")
+        return False
+
+    payload = {field: firestore.DELETE_FIELD for field in fields}
 
-async def add_scheduled_media(user_id: int, chat_id: int, message_id: int, media_file_id: str, media_type: str, schedule_time: str) -> str:
+    try:
+        await _settings_doc_ref(db, app_id, user_id).set(payload, merge=True)
+        logger.info("Cleared settings %s for user %s", fields, user_id)
+        return True
+    except Exception as e:
+        logger.error("Error clearing settings %s for user %s: %s", fields, user_id, e)
+        return False
+
+async def add_scheduled_media(user_id: int, chat_id: int, message_id: int, media_file_id: str, media_type: int, schedule_time: str) -> str:
     """Adds a scheduled media entry to Firestore and returns its ID."""
-    db = config.get_firestore_db()
-    app_id = config.get_app_id()
+    db, app_id = config.get_fs()
     if not db:
         logger.error("Firestore DB not available. Cannot add scheduled media.")
         return ""
-    
-    user_scheduled_media_collection_path = config.USERS_COLLECTION.format(app_id=app_id, userId=str(user_id))
-    collection_ref = db.collection(user_scheduled_media_collection_path).document(str(user_id)).collection("scheduled_media")
-    
+
+    doc_ref = _scheduled_media_collection_ref(db, app_id, user_id).document() # Auto-generated ID
+
     try:
-        doc_ref = await asyncio.to_thread(collection_ref.add, {
+        await doc_ref.set({
             "chat_id": chat_id,
             "message_id": message_id,
             "media_file_id": media_file_id,
-            "media_type": media_type,
+            "media_type": int(media_type), # utils.MediaType value
             "schedule_time": schedule_time, # HH:MM string (UTC)
             "user_id": user_id, # Store user_id explicitly for easier querying
             "created_at": firestore.SERVER_TIMESTAMP
         })
-        logger.info(f"Added scheduled media for user {user_id}: {doc_ref.id}")
+        logger.info("Added scheduled media for user %s: %s", user_id, doc_ref.id)
         return doc_ref.id
     except Exception as e:
-        logger.error(f"Error adding scheduled media for user {user_id}: {e}")
+        logger.error("Error adding scheduled media for user %s: %s", user_id, e)
         return ""
 
 async def get_all_scheduled_media(user_id: int) -> list[dict]:
     """Fetches all scheduled media for a specific user."""
-    db = config.get_firestore_db()
-    app_id = config.get_app_id()
+    db, app_id = config.get_fs()
     if not db:
         logger.error("Firestore DB not available.")
         return []
 
-    user_scheduled_media_collection_path = config.USERS_COLLECTION.format(app_id=app_id, userId=str(user_id))
-    collection_ref = db.collection(user_scheduled_media_collection_path).document(str(user_id)).collection("scheduled_media")
-    
+    collection_ref = _scheduled_media_collection_ref(db, app_id, user_id)
+
     try:
-        docs = await asyncio.to_thread(collection_ref.get)
+        docs = await collection_ref.get()
         return [{**doc.to_dict(), "id": doc.id} for doc in docs]
     except Exception as e:
-        logger.error(f"Error fetching scheduled media for user {user_id}: {e}")
+        logger.error("Error fetching scheduled media for user %s: %s", user_id, e)
         return []
 
-async def delete_scheduled_media(user_id: int, media_id: str):
-    """Deletes a scheduled media entry from Firestore."""
-    db = config.get_firestore_db()
-    app_id = config.get_app_id()
+async def delete_scheduled_media(user_id: int, media_id: str) -> Optional[bool]:
+    """Deletes a scheduled media entry from Firestore.
+
+    The document lives under the user's own path, so ownership is implied; the delete is
+    conditioned on the document existing. Returns True if deleted, False if no such entry
+    exists (including malformed IDs), and None if the delete failed.
+    """
+    db, app_id = config.get_fs()
     if not db:
         logger.error("Firestore DB not available. Cannot delete scheduled media.")
-        return
-    
-    user_scheduled_media_collection_path = config.USERS_COLLECTION.format(app_id=app_id, userId=str(user_id))
-    doc_ref = db.collection(user_scheduled_media_collection_path).document(str(user_id)).collection("scheduled_media").document(media_id)
-    
+        return None
+
     try:
-        await asyncio.to_thread(doc_ref.delete)
-        logger.info(f"Deleted scheduled media {media_id} for user {user_id}")
+        doc_ref = _scheduled_media_collection_ref(db, app_id, user_id).document(media_id)
+        await doc_ref.delete(option=db.write_option(exists=True))
+        logger.info("Deleted scheduled media %s for user %s", media_id, user_id)
+        return True
+    except (NotFound, ValueError): # ValueError: the ID is not a valid document path segment
+        return False
     except Exception as e:
-        logger.error(f"Error deleting scheduled media {media_id} for user {user_id}: {e}")
-
+        logger.error("Error deleting scheduled media %s for user %s: %s", media_id, user_id, e)
+        return None
@@ -7,15 +7,47 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, CallbackQuery
 from apscheduler.schedulers.asyncio import AsyncIOScheduler # Import scheduler
+from google.cloud import firestore
 
 import db_manager
-from jobs import delete_message_job, send_scheduled_media_job
-from utils import get_media_file_id, send_media_by_type
+from jobs import delete_messages_job, pending_deletions, send_scheduled_media_job
+from utils import get_media_file_id, media_type_label, parse_hhmm, send_media_by_type
 
 logger = logging.getLogger(__name__)
 
-# Get APScheduler instance for job management
-scheduler = AsyncIOScheduler() # This should ideally be passed in from main or accessed globally (carefully)
+# APScheduler instance for job management; the started scheduler is handed over by register_handlers
+scheduler: AsyncIOScheduler = None
+
+# --- Static Replies ---
+# Built once at import; only the username in the /start greeting varies per call.
+_START_TEMPLATE = (
+    "Hello, {username}! 👋\n\n"
+    "I'm your Night Mode Bot for Telegram media.\n\n"
+    "Here's what I can do:\n"
+    "🌙 **Automatic Media Deletion (Night Mode)**\n"
+    "  - Use `/set_delete_timer <minutes>` to have stickers, GIFs, photos, and videos automatically deleted after the set time.\n"
+    "  - Example: `/set_delete_timer 5` (deletes media after 5 minutes).\n"
+    "  - Use `/cancel_delete_timer` to stop automatic deletion.\n\n"
+    "⏰ **Scheduled Media Sending**\n"
+    "  - Use `/schedule_media <HH:MM>` to schedule a sticker, GIF, photo, or video to be sent daily at a specific time.\n"
+    "  - Example: `/schedule_media 08:00` (sends media daily at 8 AM UTC).\n"
+    "  - Use `/cancel_schedule` to view and cancel your scheduled media.\n\n"
+    "Type /help for more information."
+)
+
+_HELP_TEXT = (
+    "Here's how to use me:\n\n"
+    "🌙 **Automatic Media Deletion:**\n"
+    "  - `/set_delete_timer <minutes>`: Start auto-deletion. After this, any *new* media you send (sticker, GIF, photo, video) in *this chat* will be deleted after `<minutes>`. The bot needs to be an admin in groups with 'delete messages' permission.\n"
+    "  - `/cancel_delete_timer`: Stop auto-deletion.\n\n"
+    "⏰ **Scheduled Media Sending:**\n"
+    "  - `/schedule_media <HH:MM>`: Prepare to schedule media. After this, send the media you want to schedule.\n"
+    "  - `/cancel_schedule`: List your scheduled media and cancel them by ID.\n\n"
+    "**Important Notes:**\n"
+    "- All times are in **UTC** for scheduling.\n"
+    "- For auto-deletion in groups, I need to be an admin with **'Delete Messages'** permission.\n"
+    "- I only handle stickers, GIFs, photos, and videos for now.\n"
+)
 
 # --- FSM States for Bot Interaction ---
 class NightModeStates(StatesGroup):
@@ -24,8 +56,14 @@ class NightModeStates(StatesGroup):
     waiting_for_schedule_time = State() # Not strictly used with current flow, but kept for future expansion
 
 
-def register_handlers(dp: Dispatcher, bot: Bot):
-    """Registers all command and message handlers to the dispatcher."""
+def register_handlers(dp: Dispatcher, bot: Bot, scheduler_instance: AsyncIOScheduler):
+    """Registers all command and message handlers to the dispatcher.
+
+    The handlers add and remove jobs on `scheduler_instance`, which must be the scheduler main starts.
+    """
+    global scheduler
+    scheduler = scheduler_instance
+
     # Command handlers
     dp.message.register(command_start_handler, Command("start"))
     dp.message.register(command_help_handler, Command("help"))
@@ -53,20 +91,7 @@ async def command_start_handler(message: Message, state: FSMContext) -> None:
     await state.clear()
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
-    await message.answer(
-        f"Hello, {username}! 👋\n\n"
-        "I'm your Night Mode Bot for Telegram media.\n\n"
-        "Here's what I can do:\n"
-        "🌙 **Automatic Media Deletion (Night Mode)**\n"
-        "  - Use `/set_delete_timer <minutes>` to have stickers, GIFs, photos, and videos automatically deleted after the set time.\n"
-        "  - Example: `/set_delete_timer 5` (deletes media after 5 minutes).\n"
-        "  - Use `/cancel_delete_timer` to stop automatic deletion.\n\n"
-        "⏰ **Scheduled Media Sending**\n"
-        "  - Use `/schedule_media <HH:MM>` to schedule a sticker, GIF, photo, or video to be sent daily at a specific time.\n"
-        "  - Example: `/schedule_media 08:00` (sends media daily at 8 AM UTC).\n"
-        "  - Use `/cancel_schedule` to view and cancel your scheduled media.\n\n"
-        "Type /help for more information."
-    )
+    await message.answer(_START_TEMPLATE.format(username=username))
     # Store user_id in Firestore if it's the first time
     await db_manager.update_user_settings(user_id, {"last_active": firestore.SERVER_TIMESTAMP})
     # Display the user ID
@@ -76,19 +101,7 @@ async def command_start_handler(message: Message, state: FSMContext) -> None:
 @dp.message(Command("help"))
 async def command_help_handler(message: Message) -> None:
     """Handles the /help command."""
-    await message.answer(
-        "Here's how to use me:\n\n"
-        "🌙 **Automatic Media Deletion:**\n"
-        "  - `/set_delete_timer <minutes>`: Start auto-deletion. After this, any *new* media you send (sticker, GIF, photo, video) in *this chat* will be deleted after `<minutes>`. The bot needs to be an admin in groups with 'delete messages' permission.\n"
-        "  - `/cancel_delete_timer`: Stop auto-deletion.\n\n"
-        "⏰ **Scheduled Media Sending:**\n"
-        "  - `/schedule_media <HH:MM>`: Prepare to schedule media. After this, send the media you want to schedule.\n"
-        "  - `/cancel_schedule`: List your scheduled media and cancel them by ID.\n\n"
-        "**Important Notes:**\n"
-        "- All times are in **UTC** for scheduling.\n"
-        "- For auto-deletion in groups, I need to be an admin with **'Delete Messages'** permission.\n"
-        "- I only handle stickers, GIFs, photos, and videos for now.\n"
-    )
+    await message.answer(_HELP_TEXT)
 
 @dp.message(Command("set_delete_timer"))
 async def set_delete_timer_command(message: Message, state: FSMContext):
@@ -106,13 +119,15 @@ async def set_delete_timer_command(message: Message, state: FSMContext):
             return
 
         user_id = message.from_user.id
-        # Store duration in user settings
-        settings = await db_manager.get_user_settings(user_id)
-        settings['delete_timer_minutes'] = duration_minutes
-        settings['delete_timer_active_chat_id'] = message.chat.id # Store which chat it's active for
-        await db_manager.update_user_settings(user_id, settings)
+        # Persist the timer in user settings; a merge write needs no prior read
+        await db_manager.update_user_settings(user_id, {
+            'delete_timer_minutes': duration_minutes,
+            'delete_timer_active_chat_id': message.chat.id, # Store which chat it's active for
+        })
 
+        # Keep the timer in FSM data too, so the media handler never has to query Firestore
         await state.set_state(NightModeStates.waiting_for_delete_duration)
+        await state.update_data(delete_minutes=duration_minutes, delete_chat_id=message.chat.id)
         await message.reply(f"Okay! I will delete stickers, GIFs, photos, and videos sent in this chat automatically after "
                             f"{duration_minutes} minute(s).\n"
                             "Now, send me the media you want to be automatically deleted, or type `/cancel_delete_timer` to stop.")
@@ -123,12 +138,10 @@ async def set_delete_timer_command(message: Message, state: FSMContext):
 async def cancel_delete_timer_command(message: Message, state: FSMContext):
     """Handles /cancel_delete_timer command."""
     user_id = message.from_user.id
-    settings = await db_manager.get_user_settings(user_id)
-    if 'delete_timer_minutes' in settings:
-        del settings['delete_timer_minutes']
-        if 'delete_timer_active_chat_id' in settings:
-            del settings['delete_timer_active_chat_id']
-        await db_manager.update_user_settings(user_id, settings)
+    # Always drop the persisted timer (one write, no read), even after a restart or from another chat
+    await db_manager.clear_settings_fields(user_id, ['delete_timer_minutes', 'delete_timer_active_chat_id'])
+    # Media is only auto-deleted while this state is set, so it tells us whether this chat had a timer running
+    if await state.get_state() == NightModeStates.waiting_for_delete_duration.state:
         await state.clear()
         await message.reply("Automatic media deletion has been cancelled.")
     else:
@@ -137,11 +150,10 @@ async def cancel_delete_timer_command(message: Message, state: FSMContext):
 @dp.message(NightModeStates.waiting_for_delete_duration, content_types=[types.ContentType.STICKER, types.ContentType.ANIMATION, types.ContentType.PHOTO, types.ContentType.VIDEO])
 async def handle_media_for_deletion(message: Message, state: FSMContext):
     """Handles media messages when a delete timer is active."""
-    user_id = message.from_user.id
-    settings = await db_manager.get_user_settings(user_id)
+    data = await state.get_data()
 
-    delete_timer_minutes = settings.get('delete_timer_minutes')
-    active_chat_id = settings.get('delete_timer_active_chat_id')
+    delete_timer_minutes = data.get('delete_minutes')
+    active_chat_id = data.get('delete_chat_id')
 
     if delete_timer_minutes is None or active_chat_id != message.chat.id:
         # This state might have been left hanging or command was for another chat
@@ -149,17 +161,30 @@ async def handle_media_for_deletion(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    # Schedule the deletion
-    run_at = datetime.now() + timedelta(minutes=delete_timer_minutes)
-    scheduler.add_job(
-        delete_message_job,
-        'date',
-        run_date=run_at,
-        args=[message.bot, message.chat.id, message.message_id], # Pass bot instance to job
-        id=f"delete_msg_{message.chat.id}_{message.message_id}_{datetime.now().timestamp()}"
-    )
-    logger.info(f"Scheduled deletion for message {message.message_id} in chat {message.chat.id} at {run_at} UTC.")
-    await message.reply(f"This media will be deleted automatically in {delete_timer_minutes} minute(s).")
+    # Schedule the deletion, rounded up to the next minute so that media sent in the same
+    # minute shares one job and is removed with a single delete_messages call.
+    run_at = (datetime.now() + timedelta(minutes=delete_timer_minutes)).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    bucket_key = (message.chat.id, run_at)
+    bucket = pending_deletions[bucket_key]
+    bucket.append(message.message_id)
+    if len(bucket) == 1:
+        try:
+            scheduler.add_job(
+                delete_messages_job,
+                'date',
+                run_date=run_at,
+                args=[message.bot, message.chat.id, run_at], # Pass bot instance to job
+                id=f"delete_msgs_{message.chat.id}_{int(run_at.timestamp())}",
+                # The job is the only thing that drains the bucket, so it must run even if late
+                misfire_grace_time=None,
+                coalesce=True
+            )
+        except Exception:
+            # No job will drain this bucket; drop it so later messages start a fresh one
+            pending_deletions.pop(bucket_key, None)
+            raise
+    logger.info("Scheduled deletion for message %s in chat %s at %s UTC.", message.message_id, message.chat.id, run_at)
+    await message.reply(f"This media will be deleted automatically in about {delete_timer_minutes} minute(s).")
     # Don't clear state, allow continuous auto-deletion until cancelled
 
 @dp.message(Command("schedule_media"))
@@ -173,8 +198,9 @@ async def schedule_media_command(message: Message, state: FSMContext):
 
     time_str = args[1]
     try:
-        # Validate time format
-        scheduled_time = datetime.strptime(time_str, "%H:%M").time()
+        # Validate time format and store it normalized as HH:MM
+        hour, minute = parse_hhmm(time_str)
+        time_str = f"{hour:02d}:{minute:02d}"
         # Store time in state
         await state.update_data(schedule_time_str=time_str)
         await state.set_state(NightModeStates.waiting_for_scheduled_media)
@@ -194,7 +220,7 @@ async def handle_scheduled_media(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    media_file_id, media_type = await get_media_file_id(message)
+    media_file_id, media_type = get_media_file_id(message)
 
     if not media_file_id:
         await message.reply("I can only schedule stickers, GIFs, photos, or videos. Please send one of these types.")
@@ -208,7 +234,7 @@ async def handle_scheduled_media(message: Message, state: FSMContext):
 
     if scheduled_id:
         # Add job to scheduler
-        hour, minute = map(int, schedule_time_str.split(':'))
+        hour, minute = parse_hhmm(schedule_time_str)
         # Using a fixed ID for the job based on scheduled_id ensures uniqueness
         # and allows `replace_existing=True` to re-register on bot restart.
         scheduler.add_job(
@@ -242,15 +268,15 @@ async def cancel_schedule_command_no_arg(message: Message):
         await message.reply("You have no scheduled media.")
         return
 
-    response_text = "Your scheduled media:\n\n"
-    for item in scheduled_items:
-        response_text += (
-            f"ID: `{item['id']}`\n"
-            f"Type: `{item['media_type'].capitalize()}`\n"
-            f"Time: `{item['schedule_time']} UTC`\n"
-            f"Chat ID: `{item['chat_id']}`\n"
-            f"To cancel, use `/cancel_schedule {item['id']}`.\n\n"
-        )
+    entries = [
+        f"ID: `{item['id']}`\n"
+        f"Type: `{media_type_label(item['media_type']).capitalize()}`\n"
+        f"Time: `{item['schedule_time']} UTC`\n"
+        f"Chat ID: `{item['chat_id']}`\n"
+        f"To cancel, use `/cancel_schedule {item['id']}`.\n\n"
+        for item in scheduled_items
+    ]
+    response_text = "Your scheduled media:\n\n" + "".join(entries)
     await message.reply(response_text, parse_mode=types.ParseMode.MARKDOWN)
 
 async def process_cancel_schedule_id(message: Message):
@@ -259,27 +285,19 @@ async def process_cancel_schedule_id(message: Message):
     schedule_id_to_cancel = args[1]
     user_id = message.from_user.id
     
-    # Verify the user actually owns this scheduled ID
-    scheduled_items = await db_manager.get_all_scheduled_media(user_id)
-    found = False
-    for item in scheduled_items:
-        if item['id'] == schedule_id_to_cancel:
-            found = True
-            break
-    
-    if not found:
+    # The document path is scoped to the user, so a single conditional delete both
+    # verifies ownership and removes the entry.
+    deleted = await db_manager.delete_scheduled_media(user_id, schedule_id_to_cancel)
+    if deleted is None:
+        await message.reply("Failed to cancel scheduled media due to a database error. Please try again.")
+        return
+    if not deleted:
         await message.reply(f"No scheduled media found with ID: `{schedule_id_to_cancel}` for your user. Please check the ID and try again.")
         return
 
-    try:
-        await db_manager.delete_scheduled_media(user_id, schedule_id_to_cancel)
-        # Remove job from scheduler
-        job_id = f"send_sch_{schedule_id_to_cancel}"
-        if scheduler.get_job(job_id):
-            scheduler.remove_job(job_id)
-            logger.info(f"Removed APScheduler job {job_id}")
-        await message.reply(f"Scheduled media with ID `{schedule_id_to_cancel}` has been cancelled and removed.")
-    except Exception as e:
-        logger.error(f"Error cancelling scheduled media {schedule_id_to_cancel}: {e}")
-        await message.reply(f"Failed to cancel scheduled media. Error: {e}")
-
+    # Remove job from scheduler
+    job_id = f"send_sch_{schedule_id_to_cancel}"
+    if scheduler.get_job(job_id):
+        scheduler.remove_job(job_id)
+        logger.info("Removed APScheduler job %s", job_id)
+    await message.reply(f"Scheduled media with ID `{schedule_id_to_cancel}` has been cancelled and removed.")
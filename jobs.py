@@ -1,25 +1,36 @@
 import logging
+from collections import defaultdict
+from datetime import datetime
 from aiogram import Bot
 import utils
 import db_manager # To delete from db if needed after sending/failure
 
 logger = logging.getLogger(__name__)
 
-async def delete_message_job(bot: Bot, chat_id: int, message_id: int):
-    """Job to delete a specific message."""
-    try:
-        await bot.delete_message(chat_id, message_id)
-        logger.info(f"Deleted message {message_id} in chat {chat_id}")
-    except Exception as e:
-        logger.error(f"Failed to delete message {message_id} in chat {chat_id}: {e}")
+# Bot API limit on message IDs per deleteMessages call.
+DELETE_MESSAGES_BATCH_SIZE = 100
 
-async def send_scheduled_media_job(bot: Bot, user_id: int, chat_id: int, media_file_id: str, media_type: str, schedule_id: str):
+# Messages awaiting auto-deletion, keyed by (chat_id, run_at) bucket.
+# Only the first message in a bucket schedules a job; the job drains the whole bucket.
+pending_deletions: defaultdict[tuple[int, datetime], list[int]] = defaultdict(list)
+
+async def delete_messages_job(bot: Bot, chat_id: int, run_at: datetime):
+    """Job to delete every message collected in a (chat, run time) bucket."""
+    message_ids = pending_deletions.pop((chat_id, run_at), [])
+    for start in range(0, len(message_ids), DELETE_MESSAGES_BATCH_SIZE):
+        batch = message_ids[start:start + DELETE_MESSAGES_BATCH_SIZE]
+        try:
+            await bot.delete_messages(chat_id, batch)
+        except Exception as e:
+            logger.error("Failed to delete messages %s in chat %s: %s", batch, chat_id, e)
+
+async def send_scheduled_media_job(bot: Bot, user_id: int, chat_id: int, media_file_id: str, media_type: int, schedule_id: str):
     """Job to send scheduled media."""
-    success = await utils.send_media_by_type(chat_id, media_file_id, media_type)
+    success = await utils.send_media_by_type(chat_id, media_file_id, media_type, bot)
     if success:
-        logger.info(f"Sent scheduled media {schedule_id} to chat {chat_id}")
+        logger.info("Sent scheduled media %s to chat %s", schedule_id, chat_id)
     else:
-        logger.error(f"Failed to send scheduled media {schedule_id} to chat {chat_id}")
+        logger.error("Failed to send scheduled media %s to chat %s", schedule_id, chat_id)
         # Optionally, you might want to log this failure or notify the user
         # or even retry, depending on your bot's logic.
       
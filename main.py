@@ -4,24 +4,32 @@ import json
 import os
 
 from aiogram import Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
 
-# Firebase imports
-import firebase_admin
-from firebase_admin import credentials, firestore
+# Firestore imports
+from google.cloud import firestore
+from google.oauth2 import service_account
 
 # Local imports
 import config
 from db_manager import get_all_scheduled_media, get_user_settings, update_user_settings
 from handlers import register_handlers
 from jobs import send_scheduled_media_job
-from utils import get_media_file_id, send_media_by_type
+from utils import get_media_file_id, parse_hhmm, send_media_by_type
 
 logger = logging.getLogger(__name__)
 
+# Number of key-range partitions the scheduled_media collection group is read in on startup.
+RESCHEDULE_PARTITION_COUNT = 8
+# Only these fields are needed to rebuild a job, so startup reads project to them.
+RESCHEDULE_FIELDS = ['chat_id', 'media_file_id', 'media_type', 'schedule_time']
+
 async def initialize_firebase_and_db():
-    """Initializes Firebase and returns the Firestore client."""
+    """Initializes Firebase and returns the async Firestore client."""
     try:
         # Use environment variables provided by Canvas or fallback for local dev
         app_id = os.getenv('__app_id', config.DEFAULT_APP_ID)
@@ -33,23 +41,56 @@ async def initialize_firebase_and_db():
             return None, app_id
 
         firebase_config = json.loads(firebase_config_str)
-        cred = credentials.Certificate(firebase_config)
-        
-        # Check if app is already initialized to prevent errors on hot reload/re-initialization
-        if not firebase_admin._apps:
-            firebase_admin.initialize_app(cred)
-            logger.info("Firebase app initialized.")
-        else:
-            logger.info("Firebase app already initialized.")
-
-        db = firestore.client()
-        logger.info("Firestore client obtained.")
+        cred = service_account.Credentials.from_service_account_info(firebase_config)
+
+        # Talk to Firestore directly; the Firebase Admin app wrapper adds nothing this bot uses.
+        db = firestore.AsyncClient(project=firebase_config.get('project_id'), credentials=cred)
+        logger.info("Async Firestore client obtained.")
         return db, app_id
     except Exception as e:
-        logger.error(f"Error during Firebase initialization: {e}")
+        logger.error("Error during Firebase initialization: %s", e)
         return None, config.DEFAULT_APP_ID
 
 
+async def _reschedule_partition(query, bot_instance: Bot, scheduler_instance: AsyncIOScheduler, users_collection_path: str) -> int:
+    """Streams one partition of the scheduled_media collection group and re-adds its jobs."""
+    jobs_rescheduled = 0
+    async for doc in query.stream():
+        # The collection group also matches any deeper or other-app collection named
+        # scheduled_media, so only accept documents directly under this app's users.
+        user_doc_ref = doc.reference.parent.parent
+        if user_doc_ref is None or user_doc_ref.path != f"{users_collection_path}/{user_doc_ref.id}":
+            logger.warning("Skipping scheduled media document outside %s: %s", users_collection_path, doc.reference.path)
+            continue
+
+        item = doc.to_dict()
+        try:
+            user_id_str = user_doc_ref.id # Get user ID from path: users/{user_id}/scheduled_media/{doc_id}
+            user_id = int(user_id_str)
+
+            # Ensure all required fields are present
+            if all(k in item for k in RESCHEDULE_FIELDS):
+                hour, minute = parse_hhmm(item['schedule_time'])
+                trigger = CronTrigger(hour=hour, minute=minute, second=0, timezone='UTC')
+                scheduler_instance.add_job(
+                    send_scheduled_media_job,
+                    trigger,
+                    args=[bot_instance, user_id, item['chat_id'], item['media_file_id'], item['media_type'], doc.id],
+                    id=f"send_sch_{doc.id}",
+                    replace_existing=True # Important for re-scheduling on startup
+                )
+                logger.info("Rescheduled job %s for user %s at %s UTC.", doc.id, user_id, item['schedule_time'])
+                jobs_rescheduled += 1
+            else:
+                logger.warning("Skipping incomplete scheduled media document: %s", doc.id)
+
+        except ValueError:
+            logger.error("Invalid user ID or time format in scheduled media document: %s", doc.id)
+        except Exception as e:
+            logger.error("Error rescheduling job %s: %s", doc.id, e)
+    return jobs_rescheduled
+
+
 async def load_and_reschedule_media(bot_instance: Bot, scheduler_instance: AsyncIOScheduler, firestore_db):
     """Loads all scheduled media from Firestore and re-adds them to the scheduler on startup."""
     if not firestore_db:
@@ -57,70 +98,29 @@ async def load_and_reschedule_media(bot_instance: Bot, scheduler_instance: Async
         return
 
     logger.info("Loading and rescheduling all existing media...")
-    
-    # In a real multi-user scenario, this might involve more complex iteration
-    # or a dedicated collection for all scheduled jobs if performance is critical.
-    # For now, we iterate through all known users' scheduled_media subcollections.
-    
-    # Note: This is a simplified approach. If you have millions of users,
-    # you'd need a more optimized way to query all scheduled items across subcollections.
-    # A Collection Group Query could be used, but requires indexes.
-    
-    # We will assume that `get_all_scheduled_media` can effectively retrieve across users
-    # by iterating through user IDs that exist in the `USERS_COLLECTION`
-    # Or for a single-user bot, simply query the user's collection.
 
+    # scheduled_media is a subcollection under every user document, so a Collection Group
+    # Query reads all of them at once. The SDK streams a single query serially, so the
+    # collection group is split into key-range partitions that are streamed concurrently.
     total_jobs_rescheduled = 0
-    # This is a placeholder for fetching user IDs. In a real app, you might have a
-    # master list of user IDs or iterate through users collection.
-    # For this simplified example, we'll try to guess user IDs or assume they are known.
-    # A robust solution might use a dedicated 'all_scheduled_jobs' collection at the root.
-    
-    # As the bot runs, users interact, and their IDs get into Firestore implicitly.
-    # For loading, we need to find existing user documents.
+    _, app_id = config.get_fs()
+    users_collection_path = config.USERS_COLLECTION.format(app_id=app_id)
     try:
-        users_ref = firestore_db.collection(config.USERS_COLLECTION.format(app_id='*')) # Use wildcard if no specific app_id known at this stage
-        # This wildcard approach doesn't work directly with Firebase `collection` method.
-        # Instead, we need to use a Collection Group Query if `scheduled_media` is a subcollection
-        # under different user IDs.
-        
-        # A more direct (but potentially less efficient for many users) way is to get all
-        # user documents and then their subcollections.
-        
-        user_docs_stream = firestore_db.collection_group("scheduled_media").stream()
-        
-        # Iterate through scheduled media directly using a collection group query
-        for doc in user_docs_stream:
-            item = doc.to_dict()
-            try:
-                user_id_str = doc.reference.parent.parent.id # Get user ID from path: users/{user_id}/scheduled_media/{doc_id}
-                user_id = int(user_id_str)
-
-                # Ensure all required fields are present
-                if all(k in item for k in ['chat_id', 'media_file_id', 'media_type', 'schedule_time']):
-                    hour, minute = map(int, item['schedule_time'].split(':'))
-                    trigger = CronTrigger(hour=hour, minute=minute, second=0, timezone='UTC')
-                    scheduler_instance.add_job(
-                        send_scheduled_media_job,
-                        trigger,
-                        args=[bot_instance, user_id, item['chat_id'], item['media_file_id'], item['media_type'], doc.id],
-                        id=f"send_sch_{doc.id}",
-                        replace_existing=True # Important for re-scheduling on startup
-                    )
-                    logger.info(f"Rescheduled job {doc.id} for user {user_id} at {item['schedule_time']} UTC.")
-                    total_jobs_rescheduled += 1
-                else:
-                    logger.warning(f"Skipping incomplete scheduled media document: {doc.id}")
-
-            except ValueError:
-                logger.error(f"Invalid user ID or time format in scheduled media document: {doc.id}")
-            except Exception as e:
-                logger.error(f"Error rescheduling job {doc.id}: {e}")
-        
+        collection_group = firestore_db.collection_group("scheduled_media")
+        partition_queries = [partition.query().select(RESCHEDULE_FIELDS) async for partition in collection_group.get_partitions(RESCHEDULE_PARTITION_COUNT)]
+        results = await asyncio.gather(*(
+            _reschedule_partition(query, bot_instance, scheduler_instance, users_collection_path) for query in partition_queries
+        ), return_exceptions=True)
+        # A failed partition must not discard the jobs the other partitions already added
+        for index, result in enumerate(results):
+            if isinstance(result, BaseException):
+                logger.error("Error rescheduling scheduled media partition %s: %s", index, result)
+            else:
+                total_jobs_rescheduled += result
     except Exception as e:
-        logger.error(f"Error loading scheduled media for rescheduling: {e}")
+        logger.error("Error loading scheduled media for rescheduling: %s", e)
 
-    logger.info(f"Finished rescheduling {total_jobs_rescheduled} jobs.")
+    logger.info("Finished rescheduling %s jobs.", total_jobs_rescheduled)
 
 
 async def main() -> None:
@@ -136,17 +136,19 @@ async def main() -> None:
     # Pass db and app_id to config and handlers
     config.set_firestore_instance(firestore_db, app_id_from_env)
     
-    bot = Bot(token=config.BOT_TOKEN, parse_mode=ParseMode.HTML)
+    # The Bot's session is shared by polling and all sends; its pool size is configurable (aiogram defaults to 100)
+    session = AiohttpSession(limit=config.BOT_SESSION_CONNECTION_LIMIT)
+    bot = Bot(token=config.BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     dp = Dispatcher()
 
-    # Register all handlers from handlers.py
-    register_handlers(dp, bot)
-
     # Start the scheduler
     scheduler = AsyncIOScheduler()
     scheduler.start()
     logger.info("APScheduler started.")
 
+    # Register all handlers from handlers.py, sharing the running scheduler with them
+    register_handlers(dp, bot, scheduler)
+
     # Load and reschedule existing jobs from Firestore
     # This needs access to the bot and the Firestore instance.
     await load_and_reschedule_media(bot, scheduler, firestore_db)
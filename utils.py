@@ -1,40 +1,191 @@
+import asyncio
 import logging
-from aiogram.types import Message, PhotoSize
+import time
+from enum import IntEnum
+from aiogram.types import InputMediaPhoto, InputMediaVideo, Message, PhotoSize
 from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 
 logger = logging.getLogger(__name__)
 
-async def get_media_file_id(message: Message):
-    """Extracts file_id and media type from a message."""
-    if message.sticker:
-        return message.sticker.file_id, "sticker"
-    elif message.animation:
-        return message.animation.file_id, "gif"
-    elif message.photo:
-        # Get the largest photo size
-        largest_photo: PhotoSize = message.photo[-1]
-        return largest_photo.file_id, "photo"
-    elif message.video:
-        return message.video.file_id, "video"
-    else:
-        return None, None
-
-async def send_media_by_type(chat_id: int, media_file_id: str, media_type: str, bot_instance: Bot):
-    """Sends media based on its type."""
+class MediaType(IntEnum):
+    """Media types the bot handles. Persisted in Firestore as the integer value."""
+    STICKER = 1
+    GIF = 2
+    PHOTO = 3
+    VIDEO = 4
+
+    @classmethod
+    def _missing_(cls, value):
+        # Documents written before the enum store the lowercase name, e.g. "sticker".
+        if isinstance(value, str):
+            return cls.__members__.get(value.upper())
+        return None
+
+    @property
+    def label(self) -> str:
+        """Lowercase display name, e.g. "gif"."""
+        return self.name.lower()
+
+def _as_media_type(value):
+    """Returns the MediaType for an enum, int or legacy name string, or None if unknown."""
     try:
-        if media_type == "sticker":
-            await bot_instance.send_sticker(chat_id, media_file_id)
-        elif media_type == "gif":
-            await bot_instance.send_animation(chat_id, media_file_id)
-        elif media_type == "photo":
-            await bot_instance.send_photo(chat_id, media_file_id)
-        elif media_type == "video":
-            await bot_instance.send_video(chat_id, media_file_id)
-        else:
-            logger.warning(f"Unknown media type for sending: {media_type}")
+        return MediaType(value)
+    except ValueError:
+        return None
+
+def media_type_label(value) -> str:
+    """Returns the display label for a stored media type, or the raw value as text if unknown."""
+    media_type = _as_media_type(value)
+    return media_type.label if media_type else str(value)
+
+def parse_hhmm(time_str: str) -> tuple[int, int]:
+    """Parses an "HH:MM" string into (hour, minute), raising ValueError if it is invalid."""
+    hour_str, sep, minute_str = time_str.partition(':')
+    # Same shape strptime("%H:%M") accepts: one or two digits on each side of the colon.
+    if not (sep and hour_str.isdigit() and minute_str.isdigit() and len(hour_str) <= 2 and len(minute_str) <= 2):
+        raise ValueError(f"Invalid HH:MM time: {time_str!r}")
+    hour, minute = int(hour_str), int(minute_str)
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f"Time out of range: {time_str!r}")
+    return hour, minute
+
+# (Message attribute, media type) pairs checked in order; the first present one wins.
+_MEDIA_ATTRS = (("sticker", MediaType.STICKER), ("animation", MediaType.GIF), ("video", MediaType.VIDEO), ("photo", MediaType.PHOTO))
+
+def get_media_file_id(message: Message):
+    """Extracts file_id and media type from a message."""
+    for attr, media_type in _MEDIA_ATTRS:
+        media = getattr(message, attr, None)
+        if media:
+            if media_type is MediaType.PHOTO:
+                # Get the largest photo size
+                largest_photo: PhotoSize = media[-1]
+                return largest_photo.file_id, media_type
+            return media.file_id, media_type
+    return None, None
+
+# Chats that recently rejected a send (bot blocked, chat gone) -> monotonic expiry time.
+# Sends to them are skipped until the entry expires, saving a request that would fail anyway.
+BLOCKED_CHAT_TTL_SECONDS = 3600
+_BLOCKED_CHATS_MAX_SIZE = 100_000
+_blocked_chats: dict[int, float] = {}
+
+def _is_chat_blocked(chat_id: int) -> bool:
+    """Returns True if chat_id failed permanently within the last BLOCKED_CHAT_TTL_SECONDS."""
+    expires_at = _blocked_chats.get(chat_id)
+    if expires_at is None:
+        return False
+    if time.monotonic() < expires_at:
+        return True
+    del _blocked_chats[chat_id]
+    return False
+
+def _mark_chat_blocked(chat_id: int):
+    """Remembers that sends to chat_id fail, evicting expired entries when the table is full."""
+    now = time.monotonic()
+    if len(_blocked_chats) >= _BLOCKED_CHATS_MAX_SIZE:
+        for expired_chat_id in [cid for cid, expires_at in _blocked_chats.items() if expires_at <= now]:
+            del _blocked_chats[expired_chat_id]
+    if len(_blocked_chats) < _BLOCKED_CHATS_MAX_SIZE:
+        _blocked_chats[chat_id] = now + BLOCKED_CHAT_TTL_SECONDS
+
+# Media type -> Bot method used to send it.
+_SENDERS = {MediaType.STICKER: "send_sticker", MediaType.GIF: "send_animation", MediaType.PHOTO: "send_photo", MediaType.VIDEO: "send_video"}
+
+async def send_media_by_type(chat_id: int, media_file_id: str, media_type: int, bot_instance: Bot):
+    """Sends media based on its type (a MediaType, its int value, or a legacy name string).
+
+    `bot_instance` should be the application's long-lived Bot so its HTTP session and
+    connection pool are reused; do not create a short-lived Bot per send.
+    """
+    if not media_file_id:
+        # e.g. the (None, None) fallthrough of get_media_file_id; don't spend an API call on it
+        return False
+    sender_name = _SENDERS.get(_as_media_type(media_type))
+    if sender_name is None:
+        logger.warning("Unknown media type for sending: %s", media_type)
+        return False
+    send = getattr(bot_instance, sender_name)
+    if _is_chat_blocked(chat_id):
+        return False
+
+    for attempt in range(2): # One retry after a flood-control wait
+        try:
+            await send(chat_id, media_file_id)
+            return True
+        except TelegramRetryAfter as e:
+            if attempt:
+                logger.warning("Still rate limited sending media to chat %s after retry", chat_id)
+                return False
+            await asyncio.sleep(e.retry_after)
+        except TelegramForbiddenError:
+            # The user blocked the bot or it was removed from the chat; expected, not an error.
+            _mark_chat_blocked(chat_id)
             return False
+        except TelegramBadRequest as e:
+            if "chat not found" in e.message.lower():
+                _mark_chat_blocked(chat_id)
+                return False
+            logger.error("Error sending media (type: %s, file_id: %s) to chat %s: %s", media_type, media_file_id, chat_id, e)
+            return False
+        except TelegramAPIError as e:
+            logger.error("Error sending media (type: %s, file_id: %s) to chat %s: %s", media_type, media_file_id, chat_id, e)
+            return False
+    return False
+
+async def send_media_fanout(chat_ids, media_file_id: str, media_type: int, bot_instance: Bot, per_second: float = 28, concurrency: int = 28):
+    """Sends the same media to many chats, starting at most `per_second` sends per second.
+
+    Sends are spaced evenly to stay under Telegram's ~30 messages/second bot limit, and at most
+    `concurrency` requests are in flight at once. Returns one result per chat, in order:
+    True/False from send_media_by_type, or the raised exception.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    interval = 1 / per_second
+
+    async def send_one(index: int, chat_id: int):
+        await asyncio.sleep(index * interval) # Start time of this send in the paced sequence
+        async with semaphore:
+            return await send_media_by_type(chat_id, media_file_id, media_type, bot_instance)
+
+    return await asyncio.gather(*(send_one(index, chat_id) for index, chat_id in enumerate(chat_ids)), return_exceptions=True)
+
+# Media types Telegram accepts in an album (sendMediaGroup takes 2-10 items; GIFs and stickers are not allowed).
+_ALBUM_MEDIA = {MediaType.PHOTO: InputMediaPhoto, MediaType.VIDEO: InputMediaVideo}
+MEDIA_GROUP_MAX_SIZE = 10
+
+async def _send_media_chunk(chat_id: int, chunk, bot_instance: Bot) -> bool:
+    """Sends one chunk of (media_file_id, media_type) items: an album, or a single media message."""
+    try:
+        if len(chunk) == 1:
+            file_id, media_type = chunk[0]
+            return await send_media_by_type(chat_id, file_id, media_type, bot_instance)
+        await bot_instance.send_media_group(chat_id, [_ALBUM_MEDIA[media_type](media=file_id) for file_id, media_type in chunk])
         return True
     except Exception as e:
-        logger.error(f"Error sending media (type: {media_type}, file_id: {media_file_id}) to chat {chat_id}: {e}")
+        logger.error("Error sending %s media item(s) to chat %s: %s", len(chunk), chat_id, e)
         return False
 
+async def send_media_group_by_types(chat_id: int, items, bot_instance: Bot) -> bool:
+    """Sends (media_file_id, media_type) items to a chat in their original order.
+
+    Each run of consecutive photos/videos is sent as albums of up to MEDIA_GROUP_MAX_SIZE; other
+    media types, and any chunk left with a single item, go through send_media_by_type. A failed
+    album or item does not stop the rest. Returns True if everything was sent.
+    """
+    # Group into runs of consecutive album-eligible items; every other item is a run of its own.
+    runs = []
+    for file_id, media_type in items:
+        media_type = _as_media_type(media_type) or media_type
+        is_album_item = media_type in _ALBUM_MEDIA
+        if is_album_item and runs and runs[-1][0]:
+            runs[-1][1].append((file_id, media_type))
+        else:
+            runs.append((is_album_item, [(file_id, media_type)]))
+
+    all_sent = True
+    for _, run in runs:
+        for start in range(0, len(run), MEDIA_GROUP_MAX_SIZE):
+            all_sent &= await _send_media_chunk(chat_id, run[start:start + MEDIA_GROUP_MAX_SIZE], bot_instance)
+    return all_sent